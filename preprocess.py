@@ -0,0 +1,120 @@
+import re
+
+# Предобработка транскрипции перед отправкой в LM Studio. Исходный текст в БД не меняется -
+# нормализованная версия используется только для промпта. Все шаги детерминированы и работают
+# за линейное время, поэтому их можно применять к каждому звонку.
+
+# Типичные галлюцинации Whisper на русском: титры и концовки видео из обучающих данных,
+# которые модель дописывает на тишине и в конце записи. Удаляются только целые фразы в конце
+# текста: "Хорошо, до новых встреч!" - обычное прощание и остается
+HALLUCINATION_PATTERNS = [
+    r'продолжение следует',
+    r'субтитры (?:сделал|создавал|подготовил[аи]?|делал)\s+\S+',
+    r'редактор субтитров(?:\s+\S+){1,3}?\s+корректор\s+\S+',
+    r'спасибо за просмотр',
+    r'подписывайтесь на (?:наш )?канал',
+    r'ставьте лайки',
+    r'до новых встреч',
+]
+HALLUCINATION_RE = re.compile(
+    r'(?:^|(?<=[.!?…]))\s*(?:' + '|'.join(f'(?:{p})' for p in HALLUCINATION_PATTERNS) + r')[\s.!?…]*$',
+    re.IGNORECASE
+)
+
+# Числительные не схлопываются: "пять пять пять" и "ноль ноль ноль" - диктовка номеров и сумм
+NUMERAL_RE = re.compile(
+    r'^(?:\d+|ноль|нуль|один|одна|одно|два|две|три|четыре|пять|шесть|семь|восемь|девять|десять|'
+    r'\w+надцать|двадцать|тридцать|сорок|пятьдесят|шестьдесят|семьдесят|восемьдесят|девяносто|'
+    r'сто|двести|триста|четыреста|\w+сот|тысяч[аи]?|миллион\w*)$'
+)
+
+# Слова-паразиты, которые не несут смысла для анализа (только междометия, без "ну", "вот" и т.п.)
+FILLER_RE = re.compile(r'(?<!\w)(?:э+|э+м+|м+|хм+|кхм|а{2,}|ы+)(?!\w)[,.]?', re.IGNORECASE)
+
+# Сравнение слов в n-граммах без учета регистра и пунктуации
+WORD_STRIP_RE = re.compile(r'^\W+|\W+$')
+
+
+def estimate_tokens(text):
+    """Примерная оценка числа токенов (1 слово ≈ 1.3 токена, как в split_long_text)"""
+    return round(len(text.split()) * 1.3)
+
+
+def strip_hallucinations(text):
+    """Удаление известных галлюцинаций Whisper - целых фраз в конце текста, по одной с конца"""
+    while True:
+        stripped = HALLUCINATION_RE.sub('', text, count=1)
+        if stripped == text:
+            return text
+        text = stripped
+
+
+def condense_fillers(text):
+    """Удаление междометий-паразитов (э, эм, ммм, ааа)"""
+    return FILLER_RE.sub(' ', text)
+
+
+def collapse_repeated_ngrams(text, max_n=8, min_repeats=3, min_word_repeats=5):
+    """
+    Схлопывание зацикленных фраз: n-грамма, повторенная подряд min_repeats и более раз
+    (одно слово - min_word_repeats раз), остается в одном экземпляре (последнем - он несет
+    знак конца фразы). Длинные n-граммы проверяются первыми, n-граммы из одних
+    числительных не схлопываются
+    """
+    words = text.split()
+    keys = [WORD_STRIP_RE.sub('', w).lower() for w in words]
+    result = []
+    i = 0
+    while i < len(words):
+        collapsed = False
+        for n in range(min(max_n, (len(words) - i) // min_repeats), 0, -1):
+            gram = keys[i:i + n]
+            if not any(gram) or all(NUMERAL_RE.match(key) for key in gram):
+                continue
+            repeats = 1
+            while keys[i + repeats * n:i + (repeats + 1) * n] == gram:
+                repeats += 1
+            if repeats >= (min_repeats if n > 1 else max(min_repeats, min_word_repeats)):
+                i += repeats * n
+                result.extend(words[i - n:i])
+                collapsed = True
+                break
+        if not collapsed:
+            result.append(words[i])
+            i += 1
+    return ' '.join(result)
+
+
+def normalize_whitespace(text):
+    """Нормализация пробелов и пунктуации"""
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s+([,.!?;:])', r'\1', text)          # пробел перед знаком препинания
+    text = re.sub(r'\.{4,}|…+', '...', text)               # многоточия
+    text = re.sub(r'([,!?;:])\1+', r'\1', text)            # повторяющиеся знаки
+    text = re.sub(r'(?:[,;:]\s*)+([.!?])', r'\1', text)    # висящие запятые перед концом фразы
+    text = re.sub(r'^[\s,.;:!?]+', '', text)               # пунктуация в начале текста
+    return text.strip()
+
+
+def preprocess_transcript(text, fillers=False):
+    """
+    Полный цикл предобработки. Возвращает нормализованный текст
+    и статистику (токены до/после, сэкономлено)
+    """
+    tokens_before = estimate_tokens(text)
+
+    cleaned = strip_hallucinations(text)
+    if fillers:
+        cleaned = condense_fillers(cleaned)
+    cleaned = normalize_whitespace(cleaned)
+    cleaned = collapse_repeated_ngrams(cleaned)
+    cleaned = normalize_whitespace(cleaned)
+
+    tokens_after = estimate_tokens(cleaned)
+    return cleaned, {
+        'chars_before': len(text),
+        'chars_after': len(cleaned),
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved': tokens_before - tokens_after,
+    }
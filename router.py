@@ -0,0 +1,127 @@
+import os
+import re
+import json
+
+from preprocess import estimate_tokens
+
+# Маршрутизация звонков перед анализом. Дешевый локальный классификатор делит звонки на уровни:
+#   trivial  - сброс, автоответчик, ошиблись номером: анализ по шаблону, без LM Studio
+#   standard - обычный разговор: основная модель
+#   complex  - длинный разговор: модель для сложных звонков (по умолчанию та же)
+# Сначала применяются правила, затем (если задан ROUTER_MODEL_PATH) небольшая CPU-модель -
+# любой объект с методом predict([text]), сохраненный через joblib (например, sklearn Pipeline
+# из TfidfVectorizer и LogisticRegression), возвращающий одну из меток TIERS.
+
+try:
+    import joblib
+except ImportError:  # Модель классификатора необязательна, без joblib работают только правила
+    joblib = None
+
+TIERS = ('trivial', 'standard', 'complex')
+
+# Под этим именем в model_used сохраняются шаблонные анализы
+TEMPLATE_MODEL_NAME = 'router-template'
+
+ROUTER_MODEL_PATH = os.getenv('ROUTER_MODEL_PATH')
+# Текст короче стольких символов (в том числе пустой после предобработки) - разговора не было
+TRIVIAL_MAX_CHARS = 10
+# Меньше стольких слов - разговора фактически не было
+TRIVIAL_MAX_WORDS = int(os.getenv('ROUTER_TRIVIAL_MAX_WORDS', '8'))
+# Фразы автоответчика учитываются только в коротких записях, в длинных это уже разговор
+TRIVIAL_PATTERN_MAX_WORDS = int(os.getenv('ROUTER_TRIVIAL_PATTERN_MAX_WORDS', '60'))
+# Больше стольких токенов - сложный звонок
+COMPLEX_MIN_TOKENS = int(os.getenv('ROUTER_COMPLEX_MIN_TOKENS', '1500'))
+
+# Фразы автоответчиков и операторов связи, по которым звонок однозначно тривиальный
+TRIVIAL_PATTERNS = {
+    'voicemail': [
+        r'оставьте (?:ваше )?сообщение',
+        r'после (?:звукового )?сигнала',
+        r'голосов(?:ой|ую) почт',
+        r'автоответчик',
+    ],
+    'unavailable': [
+        r'абонент (?:временно )?недоступен',
+        r'аппарат абонента выключен',
+        r'находится вне зоны действия сети',
+        r'абонент не отвечает',
+        r'номер (?:набран неверно|не существует)',
+    ],
+    'wrong_number': [
+        r'ошиблись номером',
+        r'не туда попали',
+        r'вы не туда',
+    ],
+}
+TRIVIAL_RE = {
+    reason: re.compile('|'.join(patterns), re.IGNORECASE)
+    for reason, patterns in TRIVIAL_PATTERNS.items()
+}
+
+TRIVIAL_SUMMARIES = {
+    'voicemail': 'Звонок попал на автоответчик или голосовую почту, разговора не было',
+    'unavailable': 'Абонент недоступен, разговора не было',
+    'wrong_number': 'Ошибочный звонок: абонент ошибся номером',
+    'too_short': 'Разговор не состоялся: сброс звонка или слишком короткая запись',
+    'model': 'Звонок без содержательного разговора',
+}
+
+# None - еще не загружали, False - модель недоступна, работают только правила
+_classifier = None
+
+
+def load_classifier():
+    """Загрузка CPU-модели классификатора (один раз на процесс)"""
+    global _classifier
+    if _classifier is None:
+        _classifier = False
+        if ROUTER_MODEL_PATH and joblib is None:
+            print("⚠️ ROUTER_MODEL_PATH задан, но joblib не установлен - используются только правила")
+        elif ROUTER_MODEL_PATH:
+            try:
+                _classifier = joblib.load(ROUTER_MODEL_PATH)
+                print(f"🧭 Классификатор маршрутизации загружен: {ROUTER_MODEL_PATH}")
+            except Exception as e:
+                print(f"❌ Ошибка загрузки классификатора {ROUTER_MODEL_PATH}: {e}")
+    return _classifier or None
+
+
+def classify_call(text):
+    """
+    Определение уровня звонка. Возвращает (tier, reason), где reason -
+    сработавшее правило или 'model' для решения CPU-модели
+    """
+    # Правила для однозначных случаев проверяем первыми, они дешевле модели
+    word_count = len(text.split())
+    if len(text.strip()) < TRIVIAL_MAX_CHARS or word_count < TRIVIAL_MAX_WORDS:
+        return 'trivial', 'too_short'
+    if word_count <= TRIVIAL_PATTERN_MAX_WORDS:
+        for reason, pattern in TRIVIAL_RE.items():
+            if pattern.search(text):
+                return 'trivial', reason
+
+    classifier = load_classifier()
+    if classifier is not None:
+        try:
+            tier = str(classifier.predict([text])[0])
+            if tier in TIERS:
+                return tier, 'model'
+            print(f"⚠️ Классификатор вернул неизвестный уровень: {tier}")
+        except Exception as e:
+            print(f"❌ Ошибка классификатора: {e}")
+
+    if estimate_tokens(text) >= COMPLEX_MIN_TOKENS:
+        return 'complex', 'long'
+    return 'standard', 'default'
+
+
+def trivial_analysis(reason):
+    """Шаблонный анализ тривиального звонка в той же структуре, что возвращает LM"""
+    return json.dumps({
+        "sentiment": "нейтральный",
+        "key_topics": [],
+        "action_items": [],
+        "summary": TRIVIAL_SUMMARIES.get(reason, TRIVIAL_SUMMARIES['too_short']),
+        "call_quality": None,  # по тексту без LM качество звонка не оценить
+        "routing": {"tier": "trivial", "reason": reason}
+    }, ensure_ascii=False, indent=2)
@@ -0,0 +1,394 @@
+from dotenv import load_dotenv
+import os
+import sys
+import json
+import psycopg2
+import uuid
+import argparse
+from datetime import datetime, timezone
+import logging
+import time
+import signal
+from prometheus_client import Counter, Gauge, start_http_server
+
+# tracing.py общий с watcher.py и лежит в корне репозитория (в контейнере - /tracing.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import new_trace_id, emit_span, get_span_logger
+from migrate import validate_schema
+
+# ==================== ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ====================
+load_dotenv('/opt/analyzer/.env')
+
+# ==================== НАСТРОЙКА ЛОГГИРОВАНИЯ ====================
+logger = logging.getLogger('backfill')
+logger.setLevel(logging.INFO)
+
+os.makedirs('/opt/analyzer/logs', exist_ok=True)
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+file_handler = logging.FileHandler('/opt/analyzer/logs/backfill.log')
+file_handler.setFormatter(formatter)
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+
+logger.addHandler(file_handler)
+logger.addHandler(console_handler)
+
+get_span_logger('backfill', os.getenv('TRACE_LOG_PATH', '/opt/analyzer/logs/trace-backfill.jsonl'))
+
+# ==================== PROMETHEUS METRICS ====================
+TASKS_ENQUEUED = Counter('backfill_tasks_enqueued', 'Total backfill tasks enqueued')
+TASKS_FAILED = Counter('backfill_tasks_failed', 'Total backfill tasks failed to enqueue')
+CHECKPOINT_ID = Gauge('backfill_checkpoint_id', 'Last transcription id enqueued by backfill')
+BACKFILL_PASS = Gauge('backfill_pass', 'Current backfill pass number')
+PENDING_LIVE = Gauge('backfill_pending_live_tasks', 'Live tasks waiting in pending')
+
+# ==================== КОНФИГУРАЦИЯ ====================
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', '192.168.1.6'),
+    'database': 'whisper_db',
+    'user': 'whisper_user',
+    'password': os.getenv('DB_PASSWORD'),
+    'port': 5432
+}
+
+PENDING_DIR = '/opt/shared/pending'
+PROCESSING_DIR = '/opt/shared/processing'
+
+# Целевые модели и версия промпта должны совпадать с настройками watcher.py. Модель выбирает
+# watcher по уровню звонка (router.py), поэтому актуальным считается анализ любой из моделей уровней
+DEFAULT_MODEL = os.getenv('LM_STUDIO_MODEL', 'Mistral-7B-Instruct-v0.3-Q4_K_M.gguf')
+DEFAULT_MODELS = sorted({
+    DEFAULT_MODEL,
+    os.getenv('LM_STUDIO_MODEL_STANDARD', DEFAULT_MODEL),
+    os.getenv('LM_STUDIO_MODEL_COMPLEX', DEFAULT_MODEL),
+})
+DEFAULT_PROMPT_VERSION = os.getenv('PROMPT_VERSION', 'v1')
+
+# Шаблонные анализы тривиальных звонков (router.py на Windows-станции) не зависят от модели,
+# поэтому по умолчанию повторно не анализируются (см. --include-templates)
+TEMPLATE_MODEL_NAME = 'router-template'
+
+# Файлы задач повторного анализа отличаются префиксом - watcher берет их после живых задач
+BACKFILL_PREFIX = 'backfill_'
+
+# Флаг для graceful shutdown
+shutdown_flag = False
+
+def signal_handler(sig, frame):
+    """Обработчик сигналов для graceful shutdown"""
+    global shutdown_flag
+    logger.info("Received shutdown signal")
+    shutdown_flag = True
+
+def sleep_interruptible(seconds):
+    """Пауза с проверкой флага shutdown каждую секунду"""
+    for _ in range(int(seconds)):
+        if shutdown_flag:
+            break
+        time.sleep(1)
+
+def pending_tasks():
+    """Количество живых задач и задач повторного анализа в очереди pending"""
+    live, backfill = 0, 0
+    for name in os.listdir(PENDING_DIR):
+        if not name.endswith('.json'):
+            continue
+        if name.startswith(BACKFILL_PREFIX):
+            backfill += 1
+        else:
+            live += 1
+    return live, backfill
+
+def in_flight_backfill():
+    """Количество задач повторного анализа, еще не разобранных watcher (pending и processing)"""
+    count = 0
+    for directory in (PENDING_DIR, PROCESSING_DIR):
+        if not os.path.isdir(directory):
+            continue
+        count += sum(1 for name in os.listdir(directory)
+                     if name.startswith(BACKFILL_PREFIX) and name.endswith('.json'))
+    return count
+
+def wait_backfill_drained():
+    """Ожидание, пока watcher разберет все задачи повторного анализа, возвращает False при shutdown"""
+    while not shutdown_flag:
+        in_flight = in_flight_backfill()
+        if in_flight == 0:
+            return True
+        logger.info(f"Waiting for {in_flight} backfill tasks in flight before the next pass")
+        sleep_interruptible(30)
+    return False
+
+def load_checkpoint(cursor, name, model, prompt_version):
+    """
+    Чтение контрольной точки: (last_id, номер прохода). Если цель (модели, версия промпта)
+    изменилась, проход начинается заново с первой транскрипции, учет задач сбрасывается
+    """
+    cursor.execute("""
+        SELECT last_id, target_model, prompt_version, pass_number
+        FROM backfill_checkpoints
+        WHERE name = %s
+    """, (name,))
+    row = cursor.fetchone()
+    if not row:
+        return 0, 1
+    last_id, saved_model, saved_prompt_version, pass_number = row
+    if (saved_model, saved_prompt_version) != (model, prompt_version):
+        logger.info(f"Target changed ({saved_model}/{saved_prompt_version} -> {model}/{prompt_version}), restarting from the beginning")
+        cursor.execute("DELETE FROM backfill_tasks WHERE name = %s", (name,))
+        return 0, 1
+    return last_id, pass_number
+
+def save_checkpoint(cursor, name, model, prompt_version, last_id, enqueued, pass_number):
+    """Сохранение контрольной точки после каждого пакета"""
+    cursor.execute("""
+        INSERT INTO backfill_checkpoints (name, target_model, prompt_version, last_id, tasks_enqueued,
+                                          pass_number, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (name) DO UPDATE SET
+            target_model = EXCLUDED.target_model,
+            prompt_version = EXCLUDED.prompt_version,
+            last_id = EXCLUDED.last_id,
+            pass_number = EXCLUDED.pass_number,
+            tasks_enqueued = CASE
+                WHEN backfill_checkpoints.target_model = EXCLUDED.target_model
+                 AND backfill_checkpoints.prompt_version = EXCLUDED.prompt_version
+                THEN backfill_checkpoints.tasks_enqueued + EXCLUDED.tasks_enqueued
+                ELSE EXCLUDED.tasks_enqueued
+            END,
+            updated_at = CURRENT_TIMESTAMP
+    """, (name, model, prompt_version, last_id, enqueued, pass_number))
+
+def record_task(cursor, name, call_id):
+    """Учет поставленной задачи: следующий проход повторит ее, если анализ так и не обновится"""
+    cursor.execute("""
+        INSERT INTO backfill_tasks (name, transcription_id)
+        VALUES (%s, %s)
+        ON CONFLICT (name, transcription_id) DO UPDATE SET
+            attempts = backfill_tasks.attempts + 1,
+            last_enqueued_at = CURRENT_TIMESTAMP
+    """, (name, call_id))
+
+def pass_tasks(cursor, name, pass_number):
+    """Количество задач, поставленных в проходе pass_number (у них ровно столько попыток)"""
+    cursor.execute("""
+        SELECT COUNT(*) FROM backfill_tasks WHERE name = %s AND attempts = %s
+    """, (name, pass_number))
+    return cursor.fetchone()[0]
+
+def fetch_batch(cursor, after_id, models, prompt_version, batch_size, include_templates=False,
+                name=None, pass_number=1):
+    """
+    Keyset-пагинация по первичному ключу: транскрипции после after_id,
+    у которых последний анализ сделан не одной из целевых моделей или другой версией промпта.
+    Первый проход идет по всей таблице, следующие - только по задачам предыдущего прохода
+    (backfill_tasks), анализ которых так и не обновился: задача упала в watcher.
+    Транскрипции без анализа не трогаем - это живая очередь генератора.
+    Шаблонные анализы берутся только с include_templates: с другой версией промпта
+    или старого формата (с call_quality), иначе звонок, снова признанный тривиальным,
+    попадал бы в каждый проход
+    """
+    retry_join = """
+        JOIN backfill_tasks bt ON bt.name = %(name)s
+             AND bt.transcription_id = t.id
+             AND bt.attempts < %(pass_number)s
+    """ if pass_number > 1 else ""
+    cursor.execute(f"""
+        SELECT t.id, t.transcription_text
+        FROM transcriptions t
+        {retry_join}
+        JOIN LATERAL (
+            SELECT ta.model_used, ta.prompt_version, ta.analysis_result
+            FROM transcription_analysis ta
+            WHERE ta.transcription_id = t.id
+            ORDER BY ta.id DESC
+            LIMIT 1
+        ) latest ON TRUE
+        WHERE t.id > %(after_id)s
+        AND CASE WHEN latest.model_used = %(template)s
+            THEN %(include_templates)s
+                 AND (latest.prompt_version IS DISTINCT FROM %(prompt_version)s
+                      OR latest.analysis_result->>'call_quality' IS NOT NULL)
+            ELSE latest.model_used IS NULL
+                 OR latest.model_used <> ALL(%(models)s)
+                 OR latest.prompt_version IS DISTINCT FROM %(prompt_version)s
+        END
+        ORDER BY t.id
+        LIMIT %(batch_size)s
+    """, {'after_id': after_id, 'template': TEMPLATE_MODEL_NAME, 'include_templates': include_templates,
+          'models': list(models), 'prompt_version': prompt_version, 'batch_size': batch_size,
+          'name': name, 'pass_number': pass_number})
+    return cursor.fetchall()
+
+def write_task(call_id, text, prompt_version):
+    """
+    Запись файла задачи повторного анализа в pending. Модель в задаче не передается -
+    watcher выбирает ее по уровню звонка, как для живых задач
+    """
+    task_uuid = str(uuid.uuid4())
+    enqueued_at = datetime.now(timezone.utc)
+    trace_id = new_trace_id()
+    task = {
+        "id": call_id,
+        "transcription_id": call_id,
+        "text": text,
+        "task_id": task_uuid,
+        "created_at": enqueued_at.isoformat(),
+        "backfill": True,
+        "prompt_version": prompt_version,
+        "trace": {
+            "trace_id": trace_id,
+            "enqueued_at": enqueued_at.isoformat()
+        }
+    }
+    filepath = os.path.join(PENDING_DIR, f"{BACKFILL_PREFIX}{call_id}_{task_uuid}.json")
+    with open(filepath, 'x', encoding='utf-8') as f:
+        json.dump(task, f, ensure_ascii=False, indent=2)
+    emit_span('backfill', 'task_create', trace_id, enqueued_at, datetime.now(timezone.utc),
+              transcription_id=call_id, task_id=task_uuid)
+
+def run_backfill(args):
+    """
+    Основной цикл: пакет -> контрольная точка -> пауза по бюджету пропускной способности.
+    Первый проход идет по всей таблице. Задачи, упавшие в watcher, остаются позади контрольной
+    точки, поэтому после прохода (когда очередь backfill разобрана) следующий проход повторяет
+    только их - до прохода, не поставившего ни одной задачи, но не больше --max-passes.
+    Номер прохода хранится в контрольной точке и переживает перезапуск
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+
+    problems = validate_schema(conn)
+    if problems:
+        for problem in problems:
+            logger.critical(problem)
+        conn.close()
+        return
+
+    cursor = conn.cursor()
+
+    if args.reset:
+        cursor.execute("DELETE FROM backfill_checkpoints WHERE name = %s", (args.name,))
+        cursor.execute("DELETE FROM backfill_tasks WHERE name = %s", (args.name,))
+        conn.commit()
+        logger.info(f"Checkpoint '{args.name}' reset")
+
+    last_id, pass_number = load_checkpoint(cursor, args.name, args.target, args.prompt_version)
+    conn.commit()
+    BACKFILL_PASS.set(pass_number)
+    logger.info(f"Backfill '{args.name}' to {args.target}/{args.prompt_version} "
+                f"pass {pass_number} starting after id {last_id}")
+
+    os.makedirs(PENDING_DIR, exist_ok=True)
+    # Пауза на одну задачу, чтобы не превышать бюджет tasks/min
+    per_task_delay = 60.0 / args.rate
+
+    try:
+        while not shutdown_flag:
+            live, backfill = pending_tasks()
+            PENDING_LIVE.set(live)
+            # Живой трафик в приоритете: ждем, пока watcher разберет очередь
+            if live > 0 or backfill >= args.max_pending:
+                logger.info(f"Queue busy (live: {live}, backfill: {backfill}), waiting")
+                sleep_interruptible(30)
+                continue
+
+            batch_size = min(args.batch_size, args.max_pending - backfill)
+            rows = fetch_batch(cursor, last_id, args.models, args.prompt_version, batch_size,
+                               args.include_templates, args.name, pass_number)
+            if not rows:
+                if pass_tasks(cursor, args.name, pass_number) == 0:
+                    conn.commit()
+                    logger.info(f"Backfill '{args.name}' completed after {pass_number} pass(es)")
+                    break
+                if pass_number >= args.max_passes:
+                    conn.commit()
+                    logger.warning(f"Backfill '{args.name}' stopped after {pass_number} passes, "
+                                   f"failed tasks are listed in backfill_tasks")
+                    break
+                # Повтор упавших задач - только когда watcher разобрал задачи текущего прохода
+                conn.commit()
+                if not wait_backfill_drained():
+                    break
+                pass_number += 1
+                last_id = 0
+                save_checkpoint(cursor, args.name, args.target, args.prompt_version, last_id, 0, pass_number)
+                conn.commit()
+                BACKFILL_PASS.set(pass_number)
+                CHECKPOINT_ID.set(last_id)
+                logger.info(f"Backfill '{args.name}' pass {pass_number}: retrying failed tasks")
+                continue
+
+            enqueued = 0
+            for call_id, text in rows:
+                try:
+                    write_task(call_id, text, args.prompt_version)
+                except Exception as e:
+                    # Контрольную точку не сдвигаем - транскрипция попадет в следующий пакет
+                    logger.error(f"Error creating backfill task for {call_id}: {e}")
+                    TASKS_FAILED.inc()
+                    break
+                record_task(cursor, args.name, call_id)
+                enqueued += 1
+                TASKS_ENQUEUED.inc()
+                last_id = call_id
+
+            save_checkpoint(cursor, args.name, args.target, args.prompt_version, last_id, enqueued, pass_number)
+            conn.commit()
+            CHECKPOINT_ID.set(last_id)
+            logger.info(f"Enqueued {enqueued} backfill tasks, pass {pass_number}, checkpoint id: {last_id}")
+
+            sleep_interruptible(max(enqueued * per_task_delay, 1))
+    finally:
+        cursor.close()
+        conn.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Повторный анализ истории после смены модели или промпта"
+    )
+    parser.add_argument('--model', dest='models', action='append',
+                        help="Целевая модель, можно указать несколько раз "
+                             "(по умолчанию - модели уровней LM_STUDIO_MODEL[_STANDARD|_COMPLEX])")
+    parser.add_argument('--prompt-version', default=DEFAULT_PROMPT_VERSION, help="Целевая версия промпта")
+    parser.add_argument('--name', default='default', help="Имя контрольной точки")
+    parser.add_argument('--batch-size', type=int, default=50, help="Размер пакета")
+    parser.add_argument('--rate', type=float, default=10.0, help="Бюджет: задач в минуту")
+    parser.add_argument('--max-pending', type=int, default=20,
+                        help="Максимум задач повторного анализа в pending одновременно")
+    parser.add_argument('--reset', action='store_true', help="Начать проход заново")
+    parser.add_argument('--max-passes', type=int, default=3,
+                        help="Максимум проходов: первый - по всей таблице, следующие повторяют задачи, упавшие в watcher")
+    parser.add_argument('--include-templates', action='store_true',
+                        help="Повторно анализировать и шаблонные анализы тривиальных звонков (router-template)")
+    args = parser.parse_args()
+
+    if args.rate <= 0:
+        parser.error("--rate должен быть больше 0")
+    for option in ('batch_size', 'max_pending', 'max_passes'):
+        if getattr(args, option) < 1:
+            parser.error(f"--{option.replace('_', '-')} должен быть не меньше 1")
+
+    args.models = sorted(set(args.models or DEFAULT_MODELS))
+    # Набор моделей в контрольной точке - при его смене проход начинается заново
+    args.target = ','.join(args.models)
+    return args
+
+def main():
+    args = parse_args()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    start_http_server(8002)
+
+    try:
+        run_backfill(args)
+    except psycopg2.Error as e:
+        logger.error(f"Database error: {e}")
+    logger.info("Backfill process finished")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import os
+import sys
+import json
 import time
 import logging
 import psycopg2
 from datetime import datetime
 
+# tracing.py общий с watcher.py и лежит в корне репозитория (в контейнере - /tracing.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import new_trace_id, emit_span
+from migrate import apply_migrations, validate_schema
+
 # Настройка логирования для отслеживания работы системы
 logging.basicConfig(
     level=logging.INFO,
@@ -31,8 +38,25 @@ class DBLoader:
 
         self.connection = None
         self.connect()  # Устанавливаем соединение с БД
+        self.prepare_schema()  # Применяем миграции до начала обработки файлов
         logging.info("DBLoader инициализирован успешно")
 
+    def prepare_schema(self):
+        """Применение миграций и проверка схемы БД при старте"""
+        if not self.connection:
+            return
+        try:
+            apply_migrations(self.connection)
+            problems = validate_schema(self.connection)
+        except Exception as e:
+            self.connection.rollback()
+            problems = [f"Ошибка миграции схемы: {e}"]
+
+        if problems:
+            for problem in problems:
+                logging.critical(problem)
+            raise SystemExit(1)
+
     def connect(self, max_retries=5, retry_delay=5):
         """Установка соединения с БД с повторными попытками"""
         for attempt in range(max_retries):
@@ -107,6 +131,11 @@ class DBLoader:
             filename = os.path.basename(file_path)
             logging.info(f"Начало обработки: {filename}")
 
+            # Трассировка: ожидание в папке считаем от появления файла (mtime)
+            trace_id = new_trace_id()
+            picked_at = time.time()
+            file_mtime = os.path.getmtime(file_path)
+
             # 🔍 ПРОВЕРКА ДУБЛИКАТОВ - проверяем существует ли файл уже в БД
             if self.check_duplicate(filename):
                 logging.warning(f"Файл уже существует в БД: {filename}")
@@ -133,11 +162,13 @@ class DBLoader:
             # ON CONFLICT обеспечивает обновление существующих записей
             query = """
                 INSERT INTO transcriptions
-                (last_name, first_name, middle_name, call_date, phone_number, transcription_text, file_name)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                (last_name, first_name, middle_name, call_date, phone_number, transcription_text, file_name, trace_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (file_name) DO UPDATE SET
                     transcription_text = EXCLUDED.transcription_text,
+                    trace_id = EXCLUDED.trace_id,
                     updated_at = CURRENT_TIMESTAMP
+                RETURNING id
             """
 
             with self.connection.cursor() as cursor:
@@ -148,8 +179,18 @@ class DBLoader:
                     file_info['call_date'],
                     file_info['phone_number'],
                     content,
-                    filename
+                    filename,
+                    trace_id
                 ))
+                transcription_id = cursor.fetchone()[0]
+                saved_at = time.time()
+                # Длительности этапов загрузки доходят до stage_timings анализа через файл задачи
+                ingest_timings = {
+                    'ingest_wait_ms': round((picked_at - file_mtime) * 1000, 1),
+                    'ingest_ms': round((saved_at - picked_at) * 1000, 1),
+                }
+                cursor.execute("UPDATE transcriptions SET ingest_timings = %s WHERE id = %s",
+                               (json.dumps(ingest_timings), transcription_id))
                 self.connection.commit()  # Фиксируем транзакцию
 
             # Перемещение обработанного файла в архивную директорию
@@ -157,6 +198,11 @@ class DBLoader:
             os.rename(file_path, processed_path)
 
             logging.info(f"Файл обработан: {filename} -> {processed_path}")
+
+            emit_span('db_loader', 'ingest_wait', trace_id, file_mtime, picked_at,
+                      transcription_id=transcription_id, file_name=filename)
+            emit_span('db_loader', 'ingest', trace_id, picked_at, saved_at,
+                      transcription_id=transcription_id, file_name=filename)
             return True
 
         except Exception as e:
@@ -0,0 +1,344 @@
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+from datetime import date, datetime
+from collections import Counter
+
+import psycopg2
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet необязателен, CSV работает без pyarrow
+    pa = None
+    pq = None
+
+# ==================== ПОТОКОВАЯ ВЫГРУЗКА ТРАНСКРИПЦИЙ И АНАЛИЗОВ ====================
+# Данные читаются серверным (именованным) курсором пакетами фиксированного размера и сразу
+# пишутся в файл - в памяти одновременно находится только один пакет. Поля JSON анализа
+# раскладываются по колонкам. Режимы: диапазон дат звонков и "с последней выгрузки"
+# (по id анализа, состояние хранится в JSON-файле, поэтому достаточно роли только для чтения).
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger('export')
+
+DB_PARAMS = {
+    'host': os.getenv('READ_DB_HOST', os.getenv('DB_HOST', 'postgres')),
+    'database': os.getenv('DB_NAME', 'whisper_db'),
+    'user': os.getenv('READ_DB_USER', os.getenv('DB_USER', 'whisper_user')),
+    'password': os.getenv('READ_DB_PASSWORD', os.getenv('DB_PASSWORD')),
+    'port': os.getenv('DB_PORT', '5432'),
+    'options': '-c default_transaction_read_only=on'
+}
+
+DEFAULT_STATE_PATH = os.getenv('EXPORT_STATE_PATH', '/opt/analyzer/export_state.json')
+
+# Колонки выгрузки и их типы в Parquet
+COLUMNS = [
+    ('transcription_id', 'int64'),
+    ('last_name', 'string'),
+    ('first_name', 'string'),
+    ('middle_name', 'string'),
+    ('call_date', 'date'),
+    ('phone_number', 'string'),
+    ('file_name', 'string'),
+    ('analysis_id', 'int64'),
+    ('analysis_date', 'timestamp'),
+    ('model_used', 'string'),
+    ('prompt_version', 'string'),
+    ('sentiment', 'string'),
+    ('call_quality', 'string'),
+    ('summary', 'string'),
+    ('key_topics', 'list'),
+    ('action_items', 'list'),
+    ('total_chunks', 'int64'),
+    ('transcription_text', 'string'),
+]
+
+
+def parquet_schema(columns):
+    types = {
+        'int64': pa.int64(),
+        'string': pa.string(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us'),
+        'list': pa.list_(pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def as_list(value):
+    if isinstance(value, list):
+        return [str(item) for item in value if item]
+    return [str(value)] if value else []
+
+
+def as_text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value) if value else None
+
+
+def most_common(chunks, key):
+    """Преобладающее значение поля по частям длинного звонка"""
+    counts = Counter(chunk[key] for chunk in chunks if isinstance(chunk.get(key), str) and chunk[key])
+    return counts.most_common(1)[0][0] if counts else None
+
+
+def flatten_analysis(analysis):
+    """
+    Раскладка JSON анализа по колонкам. Длинные звонки анализируются по частям
+    (combined_analysis) - темы и действия объединяются, резюме склеиваются, тональность
+    и качество звонка - преобладающие по частям. Колонки ta.sentiment/ta.call_quality
+    у анализов до миграции 004 могут быть пустыми, поэтому значения берутся из JSON
+    """
+    if not isinstance(analysis, dict):
+        return {'summary': None, 'key_topics': [], 'action_items': [], 'total_chunks': None,
+                'sentiment': None, 'call_quality': None}
+
+    chunks = analysis.get('combined_analysis')
+    if not isinstance(chunks, list):
+        return {
+            'summary': analysis.get('summary'),
+            'key_topics': as_list(analysis.get('key_topics')),
+            'action_items': as_list(analysis.get('action_items')),
+            'total_chunks': None,
+            'sentiment': as_text(analysis.get('sentiment')),
+            'call_quality': as_text(analysis.get('call_quality')),
+        }
+
+    chunks = [chunk for chunk in chunks if isinstance(chunk, dict)]
+    topics, actions = [], []
+    for chunk in chunks:
+        topics.extend(topic for topic in as_list(chunk.get('key_topics')) if topic not in topics)
+        actions.extend(action for action in as_list(chunk.get('action_items')) if action not in actions)
+    summaries = [chunk['summary'] for chunk in chunks if chunk.get('summary')]
+    return {
+        'summary': ' '.join(summaries) or analysis.get('combined_summary'),
+        'key_topics': topics,
+        'action_items': actions,
+        'total_chunks': analysis.get('total_chunks', len(chunks)),
+        'sentiment': as_text(analysis.get('sentiment')) or most_common(chunks, 'sentiment'),
+        'call_quality': as_text(analysis.get('call_quality')) or most_common(chunks, 'call_quality'),
+    }
+
+
+def build_query(args):
+    """SQL выгрузки: один анализ на строку, порядок по id анализа (нужен для инкрементального режима)"""
+    conditions, params = [], []
+    if args.since_id:
+        conditions.append("ta.id > %s")
+        params.append(args.since_id)
+    if args.date_from:
+        conditions.append("t.call_date >= %s")
+        params.append(args.date_from)
+    if args.date_to:
+        conditions.append("t.call_date <= %s")
+        params.append(args.date_to)
+    if not args.all_analyses:
+        # Только последний анализ звонка (индекс transcription_id, id DESC)
+        conditions.append("""NOT EXISTS (
+            SELECT 1 FROM transcription_analysis newer
+            WHERE newer.transcription_id = ta.transcription_id
+            AND newer.id > ta.id
+        )""")
+
+    query = f"""
+        SELECT t.id, t.last_name, t.first_name, t.middle_name, t.call_date, t.phone_number, t.file_name,
+               ta.id, ta.analysis_date, ta.model_used, ta.prompt_version, ta.sentiment, ta.call_quality,
+               ta.analysis_result, {'t.transcription_text' if args.text else 'NULL'}
+        FROM transcription_analysis ta
+        JOIN transcriptions t ON t.id = ta.transcription_id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY ta.id
+    """
+    return query, params
+
+
+def to_record(row):
+    (transcription_id, last_name, first_name, middle_name, call_date, phone_number, file_name,
+     analysis_id, analysis_date, model_used, prompt_version, sentiment, call_quality,
+     analysis_result, transcription_text) = row
+    flat = flatten_analysis(analysis_result)
+    return {
+        'transcription_id': transcription_id,
+        'last_name': last_name,
+        'first_name': first_name,
+        'middle_name': middle_name,
+        'call_date': call_date,
+        'phone_number': phone_number,
+        'file_name': file_name,
+        'analysis_id': analysis_id,
+        'analysis_date': analysis_date,
+        'model_used': model_used,
+        'prompt_version': prompt_version,
+        'sentiment': flat['sentiment'] or sentiment,
+        'call_quality': flat['call_quality'] or call_quality,
+        'summary': flat['summary'],
+        'key_topics': flat['key_topics'],
+        'action_items': flat['action_items'],
+        'total_chunks': flat['total_chunks'],
+        'transcription_text': transcription_text,
+    }
+
+
+class CsvSink:
+    """Инкрементальная запись CSV (списки - через '; ')"""
+
+    def __init__(self, path, columns):
+        self.columns = [name for name, _ in columns]
+        self.file = open(path, 'w', encoding='utf-8-sig', newline='')  # BOM - для Excel
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write_batch(self, records):
+        for record in records:
+            self.writer.writerow([
+                '; '.join(record[name]) if isinstance(record[name], list) else record[name]
+                for name in self.columns
+            ])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """Запись Parquet: каждый пакет - отдельная row group"""
+
+    def __init__(self, path, columns, compression):
+        self.schema = parquet_schema(columns)
+        self.writer = pq.ParquetWriter(path, self.schema,
+                                       compression=None if compression == 'none' else compression)
+
+    def write_batch(self, records):
+        table = pa.Table.from_pylist(records, schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(records))
+
+    def close(self):
+        self.writer.close()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_export(args):
+    """Выгрузка во временный файл; файл и состояние обновляются только после успешного завершения"""
+    columns = COLUMNS if args.text else [column for column in COLUMNS if column[0] != 'transcription_text']
+    tmp_path = f"{args.output}.part"
+    query, params = build_query(args)
+    total, last_analysis_id = 0, args.since_id or 0
+
+    # Сначала подключение - при недоступной БД временный файл не создается
+    conn = psycopg2.connect(**DB_PARAMS)
+    sink, completed = None, False
+    try:
+        if args.format == 'parquet':
+            sink = ParquetSink(tmp_path, columns, args.compression)
+        else:
+            sink = CsvSink(tmp_path, columns)
+
+        # Именованный курсор - результат остается на сервере и читается порциями FETCH
+        with conn.cursor(name='whisper_export') as cursor:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(args.batch_size)
+                if not rows:
+                    break
+                records = [to_record(row) for row in rows]
+                sink.write_batch(records)
+                total += len(records)
+                last_analysis_id = records[-1]['analysis_id']
+                logger.info(f"Exported {total} rows (analysis id {last_analysis_id})")
+        sink.close()
+        completed = True
+    finally:
+        # Любая ошибка, включая Ctrl+C (KeyboardInterrupt), не оставляет недописанный .part
+        if not completed:
+            if sink is not None:
+                try:
+                    sink.close()
+                except Exception as e:
+                    logger.warning(f"Error closing {tmp_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        conn.close()
+
+    os.replace(tmp_path, args.output)
+    logger.info(f"Export finished: {total} rows -> {args.output}")
+    return total, last_analysis_id
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка транскрипций и анализов в Parquet/CSV")
+    parser.add_argument('output', help="Файл выгрузки (.parquet или .csv)")
+    parser.add_argument('--format', choices=['parquet', 'csv'], help="Формат (по умолчанию - по расширению)")
+    parser.add_argument('--date-from', type=date.fromisoformat, help="Дата звонка от (ГГГГ-ММ-ДД)")
+    parser.add_argument('--date-to', type=date.fromisoformat, help="Дата звонка до (ГГГГ-ММ-ДД)")
+    parser.add_argument('--since-last', action='store_true',
+                        help="Только анализы, появившиеся после предыдущей выгрузки с тем же --name")
+    parser.add_argument('--name', default='default', help="Имя выгрузки для режима --since-last")
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help="Файл состояния инкрементальных выгрузок")
+    parser.add_argument('--all-analyses', action='store_true',
+                        help="Все анализы звонка, а не только последний")
+    parser.add_argument('--no-text', dest='text', action='store_false', help="Без текста транскрипции")
+    parser.add_argument('--batch-size', type=int, default=5000, help="Строк в пакете (и в row group)")
+    parser.add_argument('--compression', default='zstd', choices=['zstd', 'snappy', 'gzip', 'none'],
+                        help="Сжатие Parquet")
+    args = parser.parse_args()
+
+    if not args.format:
+        args.format = 'parquet' if args.output.endswith('.parquet') else 'csv'
+    if args.since_last and (args.date_from or args.date_to):
+        # Позиция инкрементальной выгрузки ушла бы дальше анализов вне диапазона дат,
+        # и следующая выгрузка пропустила бы их навсегда
+        parser.error("--since-last нельзя сочетать с --date-from/--date-to")
+    if args.format == 'parquet' and pa is None:
+        parser.error("для Parquet нужен pyarrow: pip install pyarrow")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    state = load_state(args.state) if args.since_last else {}
+    args.since_id = state.get(args.name, {}).get('last_analysis_id') if args.since_last else None
+    if args.since_id:
+        logger.info(f"Incremental export '{args.name}' after analysis id {args.since_id}")
+
+    try:
+        total, last_analysis_id = run_export(args)
+    except psycopg2.Error as e:
+        logger.error(f"Database error: {e}")
+        sys.exit(1)
+
+    if args.since_last:
+        state[args.name] = {
+            'last_analysis_id': last_analysis_id,
+            'exported_at': datetime.now().isoformat(),
+            'rows': total,
+            'output': os.path.abspath(args.output),
+        }
+        save_state(args.state, state)
+
+
+if __name__ == "__main__":
+    main()
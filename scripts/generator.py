@@ -3,13 +3,18 @@ import os
 import json
 import psycopg2
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 import time
 import signal
 import sys
 from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
+# tracing.py общий с watcher.py и лежит в корне репозитория (в контейнере - /tracing.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import new_trace_id, emit_span, get_span_logger
+from migrate import validate_schema
+
 # ==================== ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ====================
 load_dotenv('/opt/analyzer/.env')
 
@@ -35,6 +40,9 @@ console_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+# Span-записи трассировки пишутся отдельным JSON-файлом для promtail
+get_span_logger('generator', os.getenv('TRACE_LOG_PATH', '/opt/analyzer/logs/trace-generator.jsonl'))
+
 # ==================== НАСТРОЙКА PROMETHEUS METRICS ====================
 # Запускаем HTTP сервер для метрик на порту 8001
 start_http_server(8001)
@@ -110,34 +118,59 @@ def process_tasks():
             return
 
         # Получаем задачи для обработки - ИСПРАВЛЕННЫЙ ЗАПРОС
+        # ORDER BY id идет по частичному индексу idx_transcriptions_unprocessed (FIFO)
+        # created_at (timestamp без зоны, время сервера БД) читаем как timestamptz - ISO-строка с зоной
         cursor.execute("""
-            SELECT id, transcription_text
+            SELECT id, transcription_text, trace_id,
+                   created_at AT TIME ZONE current_setting('TimeZone') AS created_at, ingest_timings
             FROM transcriptions
             WHERE processed = FALSE
             AND NOT EXISTS (
                 SELECT 1 FROM transcription_analysis ta
                 WHERE ta.transcription_id = transcriptions.id
             )
+            ORDER BY id
             LIMIT 50
         """)
 
         processed_count = 0
         failed_count = 0
 
-        for call_id, text in cursor.fetchall():
+        for call_id, text, trace_id, ingested_at, ingest_timings in cursor.fetchall():
             # Проверяем флаг shutdown перед обработкой каждой задачи
             if shutdown_flag:
                 logger.info("Shutdown requested, stopping task processing")
                 break
 
             try:
+                # Отметки трассировки - UTC с зоной, watcher сравнивает их со своими часами
+                picked_at = datetime.now(timezone.utc)
+                # Строки, загруженные до появления трассировки, получают новый trace_id
+                trace_id = trace_id or new_trace_id()
+
                 # Генерируем уникальный идентификатор задачи
                 task_uuid = str(uuid.uuid4())
+
+                # Длительности этапов до watcher: загрузка (db-loader), ожидание и создание задачи.
+                # Запись файла попадает уже в smb_wait - он отсчитывается от enqueued_at
+                timings = dict(ingest_timings or {})
+                if ingested_at:
+                    timings['generator_wait_ms'] = round((picked_at - ingested_at).total_seconds() * 1000, 1)
+                enqueued_at = datetime.now(timezone.utc)
+                timings['task_create_ms'] = round((enqueued_at - picked_at).total_seconds() * 1000, 1)
+
                 task = {
                     "id": call_id,
+                    "transcription_id": call_id,
                     "text": text,
                     "task_id": task_uuid,
-                    "created_at": datetime.now().isoformat()
+                    "created_at": picked_at.isoformat(),
+                    "trace": {
+                        "trace_id": trace_id,
+                        "ingested_at": ingested_at.isoformat() if ingested_at else None,
+                        "enqueued_at": enqueued_at.isoformat(),
+                        "timings": timings
+                    }
                 }
 
                 # Используем уникальное имя файла
@@ -154,6 +187,12 @@ def process_tasks():
                     conn.commit()
                     TASKS_CREATED.inc()
                     processed_count += 1
+
+                    if ingested_at:
+                        emit_span('generator', 'generator_wait', trace_id, ingested_at, picked_at,
+                                  transcription_id=call_id, task_id=task_uuid)
+                    emit_span('generator', 'task_create', trace_id, picked_at, datetime.now(timezone.utc),
+                              transcription_id=call_id, task_id=task_uuid)
                 else:
                     logger.warning(f"Skipped duplicate task for call_id: {call_id}")
                     failed_count += 1
@@ -177,9 +216,28 @@ def process_tasks():
         logger.error(f"Unexpected error: {e}")
         DB_ERRORS.inc()
 
+def check_schema():
+    """Проверка схемы БД при старте (миграции применяет db-loader)"""
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            problems = validate_schema(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        problems = [f"Schema check failed: {e}"]
+
+    for problem in problems:
+        logger.critical(problem)
+    return not problems
+
 def main():
     logger.info("Starting generator process in continuous mode")
 
+    if not check_schema():
+        logger.critical("Database schema is not up to date, run scripts/migrate.py")
+        sys.exit(1)
+
     # Регистрируем обработчики сигналов для graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -1,3 +1,7 @@
+-- Базовая схема, создается при первом запуске контейнера PostgreSQL.
+-- Все дальнейшие изменения схемы - версионированные миграции в scripts/migrations,
+-- их применяет scripts/migrate.py (автоматически при старте db-loader)
+
 -- Создание таблицы для хранения транскрипций
 CREATE TABLE IF NOT EXISTS transcriptions (
     id SERIAL PRIMARY KEY,
@@ -0,0 +1,199 @@
+import os
+import re
+import sys
+import hashlib
+import logging
+import argparse
+import psycopg2
+
+# ==================== ВЕРСИОННЫЕ МИГРАЦИИ СХЕМЫ ====================
+# Файлы scripts/migrations/NNN_описание.sql применяются по возрастанию номера, каждый в своей
+# транзакции и ровно один раз - применённые версии записываются в таблицу schema_migrations.
+# db_loader применяет миграции при старте, остальные сервисы только проверяют схему.
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Ключ advisory lock, чтобы два сервиса не применяли миграции одновременно
+MIGRATION_LOCK_KEY = 724101
+
+# Миграция с этой строкой выполняется вне транзакции (autocommit) - для долгих пакетных
+# обновлений, которые сами фиксируют каждый пакет (DO с COMMIT). Такой файл должен содержать
+# одну команду и быть идемпотентным: при сбое он выполняется заново целиком
+NO_TRANSACTION_MARKER = '-- migrate:no-transaction'
+
+# Колонки, без которых сервисы не могут работать
+REQUIRED_COLUMNS = {
+    'transcriptions': ['id', 'transcription_text', 'file_name', 'processed', 'trace_id', 'created_at',
+                       'ingest_timings'],
+    'transcription_analysis': ['transcription_id', 'analysis_result', 'model_used', 'prompt_version',
+                               'trace_id', 'stage_timings', 'processing_time', 'sentiment', 'call_quality'],
+    'backfill_checkpoints': ['name', 'target_model', 'prompt_version', 'last_id', 'pass_number'],
+    'backfill_tasks': ['name', 'transcription_id', 'attempts'],
+}
+
+logger = logging.getLogger('migrate')
+
+
+def list_migrations():
+    """Список миграций [(версия, имя, путь)], отсортированный по версии"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Повторяющиеся номера миграций в {MIGRATIONS_DIR}")
+    return migrations
+
+
+def latest_version():
+    """Номер последней миграции в репозитории"""
+    migrations = list_migrations()
+    return migrations[-1][0] if migrations else 0
+
+
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            checksum VARCHAR(64) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_migrations(cursor):
+    """Применённые миграции {версия: checksum}"""
+    cursor.execute("SELECT to_regclass('schema_migrations')")
+    if cursor.fetchone()[0] is None:
+        return {}
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+
+def apply_migrations(conn):
+    """
+    Применение всех неприменённых миграций. Каждая миграция выполняется в отдельной
+    транзакции вместе с записью в schema_migrations (кроме помеченных NO_TRANSACTION_MARKER).
+    Возвращает число применённых
+    """
+    applied_count = 0
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            ensure_migrations_table(cursor)
+            conn.commit()
+            applied = applied_migrations(cursor)
+
+            for version, name, path in list_migrations():
+                checksum = file_checksum(path)
+                if version in applied:
+                    if applied[version] != checksum:
+                        logger.warning(f"Миграция {version}_{name} изменена после применения")
+                    continue
+
+                with open(path, 'r', encoding='utf-8') as f:
+                    migration_sql = f.read()
+
+                logger.info(f"Применение миграции {version}_{name}")
+                try:
+                    if NO_TRANSACTION_MARKER in migration_sql:
+                        conn.commit()
+                        conn.autocommit = True
+                        try:
+                            cursor.execute(migration_sql)
+                        finally:
+                            conn.autocommit = False
+                    else:
+                        cursor.execute(migration_sql)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                        (version, name, checksum)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    logger.error(f"Миграция {version}_{name} не применена")
+                    raise
+                applied_count += 1
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+
+    if applied_count:
+        logger.info(f"Применено миграций: {applied_count}")
+    return applied_count
+
+
+def validate_schema(conn, tables=None):
+    """
+    Проверка схемы при старте сервиса. tables - таблицы из REQUIRED_COLUMNS, которые нужны
+    сервису (по умолчанию все): information_schema показывает только колонки, доступные
+    текущей роли. Возвращает список проблем (пустой список - схема в порядке)
+    """
+    required = {table: REQUIRED_COLUMNS[table] for table in (tables or REQUIRED_COLUMNS)}
+    problems = []
+    with conn.cursor() as cursor:
+        applied = applied_migrations(cursor)
+        pending = [f"{version}_{name}" for version, name, _ in list_migrations() if version not in applied]
+        if pending:
+            problems.append(f"Не применены миграции: {', '.join(pending)}")
+
+        cursor.execute("""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema()
+            AND table_name = ANY(%s)
+        """, (list(required),))
+        existing = set(cursor.fetchall())
+    conn.commit()
+
+    for table, columns in required.items():
+        missing = [column for column in columns if (table, column) not in existing]
+        if missing:
+            problems.append(f"В таблице {table} нет колонок: {', '.join(missing)}")
+    return problems
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Применение миграций схемы whisper_db")
+    parser.add_argument('--check', action='store_true', help="Только проверить схему, ничего не применяя")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'postgres'),
+        database=os.getenv('DB_NAME', 'whisper_db'),
+        user=os.getenv('DB_USER', 'whisper_user'),
+        password=os.getenv('DB_PASSWORD'),
+        port=os.getenv('DB_PORT', '5432')
+    )
+    try:
+        if not args.check:
+            apply_migrations(conn)
+        problems = validate_schema(conn)
+    finally:
+        conn.close()
+
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        sys.exit(1)
+    logger.info(f"Схема в порядке, версия {latest_version()}")
+
+
+if __name__ == "__main__":
+    main()
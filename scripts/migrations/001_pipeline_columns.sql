@@ -0,0 +1,49 @@
+-- Колонки, которые используют генератор, трассировка и повторный анализ
+
+-- Флаг постановки в очередь генератором (generator.py), отсутствовал в init.sql
+ALTER TABLE transcriptions ADD COLUMN IF NOT EXISTS processed BOOLEAN NOT NULL DEFAULT FALSE;
+-- Транскрипции, по которым анализ уже есть, в очередь больше не попадают
+UPDATE transcriptions t SET processed = TRUE
+WHERE processed = FALSE
+AND EXISTS (SELECT 1 FROM transcription_analysis ta WHERE ta.transcription_id = t.id);
+
+ALTER TABLE transcriptions ADD COLUMN IF NOT EXISTS trace_id VARCHAR(32);
+ALTER TABLE transcription_analysis ADD COLUMN IF NOT EXISTS trace_id VARCHAR(32);
+ALTER TABLE transcription_analysis ADD COLUMN IF NOT EXISTS stage_timings JSONB;
+ALTER TABLE transcription_analysis ADD COLUMN IF NOT EXISTS prompt_version VARCHAR(50) NOT NULL DEFAULT 'v1';
+
+-- Контрольные точки повторного анализа (scripts/backfill.py)
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    name VARCHAR(100) PRIMARY KEY,
+    target_model VARCHAR(100) NOT NULL,
+    prompt_version VARCHAR(50) NOT NULL,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    tasks_enqueued INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_transcriptions_trace_id ON transcriptions (trace_id);
+
+COMMENT ON COLUMN transcriptions.processed IS 'Задача на анализ создана генератором';
+COMMENT ON COLUMN transcriptions.trace_id IS 'Идентификатор трассировки звонка через конвейер';
+COMMENT ON COLUMN transcription_analysis.trace_id IS 'Идентификатор трассировки звонка';
+COMMENT ON COLUMN transcription_analysis.stage_timings IS 'Разбивка задержки по этапам конвейера (мс) и статистика предобработки';
+COMMENT ON COLUMN transcription_analysis.prompt_version IS 'Версия промпта, с которой выполнен анализ';
+COMMENT ON TABLE backfill_checkpoints IS 'Контрольные точки повторного анализа истории';
+
+-- t.* в представлении зафиксирован на момент создания, поэтому пересоздаем его
+DROP VIEW IF EXISTS vw_transcription_with_analysis;
+CREATE VIEW vw_transcription_with_analysis AS
+SELECT
+    t.*,
+    ta.analysis_result,
+    ta.analysis_date,
+    ta.model_used,
+    ta.prompt_version,
+    ta.status as analysis_status,
+    ta.error_message,
+    ta.processing_time
+FROM transcriptions t
+LEFT JOIN transcription_analysis ta ON t.id = ta.transcription_id;
+
+COMMENT ON VIEW vw_transcription_with_analysis IS 'Представление для просмотра транскрипций с результатами анализа';
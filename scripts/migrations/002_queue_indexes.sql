@@ -0,0 +1,18 @@
+-- Индексы под горячие запросы очереди. Частичный индекс содержит только
+-- неподтвержденные транскрипции, поэтому его размер не растет вместе с таблицей
+
+-- Очередь генератора: processed = FALSE ... ORDER BY id LIMIT 50 и COUNT(*) по тому же условию
+CREATE INDEX IF NOT EXISTS idx_transcriptions_unprocessed
+    ON transcriptions (id)
+    WHERE processed = FALSE;
+
+-- Анти-join NOT EXISTS по transcription_id и выбор последнего анализа
+-- (LATERAL ... ORDER BY id DESC LIMIT 1 в backfill) - index-only по одному индексу
+CREATE INDEX IF NOT EXISTS idx_analysis_transcription_latest
+    ON transcription_analysis (transcription_id, id DESC);
+
+-- Покрывается idx_analysis_transcription_latest
+DROP INDEX IF EXISTS idx_analysis_transcription_id;
+
+-- Дублирует индекс ограничения UNIQUE (file_name)
+DROP INDEX IF EXISTS idx_transcriptions_filename;
@@ -0,0 +1,14 @@
+-- Один анализ на (транскрипция, модель, версия промпта). Повторная обработка той же задачи
+-- заменяет строку новой (с большим id - последний анализ всегда имеет наибольший id),
+-- анализы других моделей и промптов сохраняются для сравнения
+
+-- Удаляем накопившиеся дубликаты, оставляя последний анализ
+DELETE FROM transcription_analysis ta
+USING transcription_analysis newer
+WHERE newer.transcription_id = ta.transcription_id
+AND newer.model_used = ta.model_used
+AND newer.prompt_version = ta.prompt_version
+AND newer.id > ta.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_analysis_transcription_model_prompt
+    ON transcription_analysis (transcription_id, model_used, prompt_version);
@@ -0,0 +1,37 @@
+-- Плоские колонки анализа для чтения без разбора JSONB и уведомление
+-- о новых анализах для сброса кэша сервиса чтения (query_service.py).
+-- Колонки без DEFAULT добавляются без перезаписи таблицы и заполняются триггером
+-- для новых анализов. Старые анализы заполняются вручную пакетами (см. README)
+
+ALTER TABLE transcription_analysis ADD COLUMN IF NOT EXISTS sentiment TEXT;
+ALTER TABLE transcription_analysis ADD COLUMN IF NOT EXISTS call_quality TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_analysis_sentiment ON transcription_analysis (sentiment);
+
+COMMENT ON COLUMN transcription_analysis.sentiment IS 'Тональность из analysis_result (заполняется триггером)';
+COMMENT ON COLUMN transcription_analysis.call_quality IS 'Качество звонка из analysis_result (заполняется триггером)';
+
+CREATE OR REPLACE FUNCTION fill_analysis_projection() RETURNS trigger AS $$
+BEGIN
+    NEW.sentiment := NEW.analysis_result->>'sentiment';
+    NEW.call_quality := NEW.analysis_result->>'call_quality';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_analysis_projection ON transcription_analysis;
+CREATE TRIGGER trg_analysis_projection
+    BEFORE INSERT OR UPDATE OF analysis_result ON transcription_analysis
+    FOR EACH ROW EXECUTE FUNCTION fill_analysis_projection();
+
+CREATE OR REPLACE FUNCTION notify_analysis_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('analysis_changed', NEW.transcription_id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_analysis_changed ON transcription_analysis;
+CREATE TRIGGER trg_analysis_changed
+    AFTER INSERT OR UPDATE ON transcription_analysis
+    FOR EACH ROW EXECUTE FUNCTION notify_analysis_changed();
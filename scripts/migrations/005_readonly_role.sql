@@ -0,0 +1,16 @@
+-- Роль только для чтения результатов (сервис чтения, интеграция с CRM).
+-- Пользователь с паролем создается вручную, см. README:
+--   CREATE USER whisper_api WITH PASSWORD '...' IN ROLE whisper_reader;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'whisper_reader') THEN
+        CREATE ROLE whisper_reader NOLOGIN;
+    END IF;
+    EXECUTE format('GRANT CONNECT ON DATABASE %I TO whisper_reader', current_database());
+END
+$$;
+
+GRANT USAGE ON SCHEMA public TO whisper_reader;
+GRANT SELECT ON transcriptions, transcription_analysis, vw_transcription_with_analysis, schema_migrations
+    TO whisper_reader;
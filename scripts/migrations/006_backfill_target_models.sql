@@ -0,0 +1,6 @@
+-- Backfill сравнивает последний анализ с набором моделей уровней маршрутизации
+-- (standard/complex), в контрольной точке хранится их список через запятую.
+-- VARCHAR -> TEXT не перезаписывает таблицу
+ALTER TABLE backfill_checkpoints ALTER COLUMN target_model TYPE TEXT;
+
+COMMENT ON COLUMN backfill_checkpoints.target_model IS 'Целевые модели прохода через запятую';
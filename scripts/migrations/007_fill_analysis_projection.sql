@@ -0,0 +1,22 @@
+-- migrate:no-transaction
+-- Заполнение sentiment/call_quality у анализов, сохраненных до миграции 004 (новые заполняет триггер).
+-- Выполняется вне транзакции миграции: каждый пакет в 10 000 строк фиксируется отдельно,
+-- блокировки строк короткие. Повторный запуск продолжает с незаполненных строк
+DO $$
+DECLARE
+    last_id INTEGER := 0;
+    max_id INTEGER;
+BEGIN
+    SELECT COALESCE(MAX(id), 0) INTO max_id FROM transcription_analysis;
+    WHILE last_id < max_id LOOP
+        UPDATE transcription_analysis
+        SET sentiment = analysis_result->>'sentiment',
+            call_quality = analysis_result->>'call_quality'
+        WHERE id > last_id AND id <= last_id + 10000
+        AND sentiment IS NULL AND call_quality IS NULL
+        AND (analysis_result ? 'sentiment' OR analysis_result ? 'call_quality');
+        last_id := last_id + 10000;
+        COMMIT;
+    END LOOP;
+END
+$$;
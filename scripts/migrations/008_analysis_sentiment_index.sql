@@ -0,0 +1,7 @@
+-- Фильтр по тональности в сервисе чтения идет от transcription_analysis: индекс отдает
+-- анализы с нужной тональностью сразу в порядке страницы (transcription_id по убыванию),
+-- без обхода всех транскрипций. Одиночный индекс по sentiment больше не нужен
+CREATE INDEX IF NOT EXISTS idx_analysis_sentiment_transcription
+    ON transcription_analysis (sentiment, transcription_id DESC);
+
+DROP INDEX IF EXISTS idx_analysis_sentiment;
@@ -0,0 +1,16 @@
+-- Повторные проходы backfill: номер прохода хранится в контрольной точке (переживает перезапуск),
+-- поставленные в очередь транскрипции - в backfill_tasks. Следующий проход берет только их,
+-- если анализ так и не обновился (задача упала в watcher), а не сканирует всю таблицу заново
+
+ALTER TABLE backfill_checkpoints ADD COLUMN IF NOT EXISTS pass_number INTEGER NOT NULL DEFAULT 1;
+
+CREATE TABLE IF NOT EXISTS backfill_tasks (
+    name VARCHAR(100) NOT NULL,
+    transcription_id INTEGER NOT NULL REFERENCES transcriptions(id) ON DELETE CASCADE,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    last_enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (name, transcription_id)
+);
+
+COMMENT ON COLUMN backfill_checkpoints.pass_number IS 'Номер текущего прохода (1 - полный, далее - повторы упавших задач)';
+COMMENT ON TABLE backfill_tasks IS 'Транскрипции, поставленные backfill в очередь, и число попыток';
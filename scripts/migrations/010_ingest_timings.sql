@@ -0,0 +1,5 @@
+-- Длительности этапов db-loader (ingest_wait_ms, ingest_ms). Генератор передает их в контексте
+-- трассировки файла задачи, watcher сохраняет вместе со своими этапами в stage_timings анализа
+ALTER TABLE transcriptions ADD COLUMN IF NOT EXISTS ingest_timings JSONB;
+
+COMMENT ON COLUMN transcriptions.ingest_timings IS 'Длительности этапов загрузки в БД (мс)';
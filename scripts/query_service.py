@@ -0,0 +1,375 @@
+import os
+import re
+import json
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import RealDictCursor
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+from migrate import validate_schema
+
+# ==================== СЕРВИС ЧТЕНИЯ РЕЗУЛЬТАТОВ ====================
+# HTTP API для CRM и отчетов вместо прямых запросов к vw_transcription_with_analysis:
+#   GET /transcriptions        - список с фильтрами и keyset-пагинацией (параметр after)
+#   GET /transcriptions/<id>   - транскрипция целиком со всеми анализами
+#   GET /health, GET /metrics
+# Работает под ролью только для чтения, ответы кэшируются в памяти процесса и сбрасываются
+# по уведомлению analysis_changed (триггер на transcription_analysis).
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger('query_service')
+
+# Читаем с реплики, если она задана (READ_DB_HOST), уведомления слушаем на основном сервере
+DB_PARAMS = {
+    'host': os.getenv('READ_DB_HOST', os.getenv('DB_HOST', 'postgres')),
+    'database': os.getenv('DB_NAME', 'whisper_db'),
+    'user': os.getenv('READ_DB_USER', 'whisper_api'),
+    'password': os.getenv('READ_DB_PASSWORD'),
+    'port': os.getenv('DB_PORT', '5432'),
+    # Даже при ошибке в настройке ролей сервис не сможет ничего изменить
+    'options': '-c default_transaction_read_only=on -c statement_timeout=10000'
+}
+LISTEN_DB_HOST = os.getenv('DB_HOST', 'postgres')
+
+API_PORT = int(os.getenv('API_PORT', '8090'))
+POOL_MIN = int(os.getenv('API_POOL_MIN', '2'))
+POOL_MAX = int(os.getenv('API_POOL_MAX', '10'))
+CACHE_TTL = float(os.getenv('API_CACHE_TTL', '30'))
+CACHE_MAX_ENTRIES = int(os.getenv('API_CACHE_MAX_ENTRIES', '1000'))
+
+# Таблицы, которые читает сервис (проверяются при старте)
+READ_TABLES = ('transcriptions', 'transcription_analysis')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# ==================== PROMETHEUS METRICS ====================
+REQUESTS = Counter('query_service_requests', 'Total API requests', ['endpoint', 'status'])
+CACHE_HITS = Counter('query_service_cache_hits', 'Responses served from cache')
+CACHE_INVALIDATIONS = Counter('query_service_cache_invalidations', 'Cache invalidations on new analyses')
+QUERY_TIME = Histogram('query_service_query_time', 'Time spent in database queries')
+
+
+class ResponseCache:
+    """
+    LRU-кэш ответов с TTL. Полностью сбрасывается при появлении нового анализа;
+    поколение не дает сохранить ответ, прочитанный до сброса
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class BadRequest(Exception):
+    """Ошибка в параметрах запроса (HTTP 400)"""
+
+
+cache = ResponseCache(CACHE_TTL, CACHE_MAX_ENTRIES)
+db_pool = None
+
+# Плоская проекция по умолчанию: без текста транскрипции и без разбора JSONB
+SLIM_COLUMNS = """
+    t.id, t.last_name, t.first_name, t.middle_name, t.call_date, t.phone_number, t.created_at,
+    la.analysis_date, la.model_used, la.prompt_version, la.sentiment, la.call_quality
+"""
+FULL_COLUMNS = SLIM_COLUMNS + ", t.transcription_text, la.analysis_result"
+
+
+def parse_date(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"{name}: ожидается дата в формате ГГГГ-ММ-ДД")
+
+
+def parse_int(params, name, default=None, minimum=1, maximum=None):
+    value = params.get(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"{name}: ожидается целое число")
+    if number < minimum or (maximum is not None and number > maximum):
+        raise BadRequest(f"{name}: допустимо от {minimum} до {maximum}")
+    return number
+
+
+def run_query(query, args):
+    """Выполнение запроса на соединении из пула"""
+    conn = db_pool.getconn()
+    try:
+        # autocommit - соединения пула не остаются в idle in transaction
+        conn.autocommit = True
+        with QUERY_TIME.time(), conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+
+def list_transcriptions(params):
+    """
+    Список транскрипций с последним анализом. Keyset-пагинация по id (от новых к старым):
+    следующая страница запрашивается с after=<next_after> из предыдущего ответа
+    """
+    limit = parse_int(params, 'limit', DEFAULT_LIMIT, maximum=MAX_LIMIT)
+    after = parse_int(params, 'after')
+    date_from = parse_date(params, 'date_from')
+    date_to = parse_date(params, 'date_to')
+    full = params.get('full') in ('1', 'true')
+    sentiment = params.get('sentiment')
+    # С фильтром по тональности выборку ведет индекс (sentiment, transcription_id DESC)
+    # по transcription_analysis, без него - первичный ключ transcriptions
+    id_column = 'la.transcription_id' if sentiment else 't.id'
+
+    conditions, args = [], []
+    if after:
+        conditions.append(f"{id_column} < %s")
+        args.append(after)
+    if params.get('operator'):
+        # operator=Фамилия или operator=Фамилия Имя
+        name_parts = params['operator'].split()
+        conditions.append("t.last_name = %s")
+        args.append(name_parts[0])
+        if len(name_parts) > 1:
+            conditions.append("t.first_name = %s")
+            args.append(name_parts[1])
+    if params.get('phone'):
+        conditions.append("t.phone_number = %s")
+        args.append(params['phone'])
+    if date_from:
+        conditions.append("t.call_date >= %s")
+        args.append(date_from)
+    if date_to:
+        conditions.append("t.call_date <= %s")
+        args.append(date_to)
+    if sentiment:
+        # Только последний анализ звонка (индекс transcription_id, id DESC)
+        conditions.append("la.sentiment = %s")
+        args.append(sentiment)
+        conditions.append("""NOT EXISTS (
+            SELECT 1 FROM transcription_analysis newer
+            WHERE newer.transcription_id = la.transcription_id
+            AND newer.id > la.id
+        )""")
+        source = """
+        FROM transcription_analysis la
+        JOIN transcriptions t ON t.id = la.transcription_id
+        """
+    else:
+        source = f"""
+        FROM transcriptions t
+        LEFT JOIN LATERAL (
+            SELECT ta.analysis_date, ta.model_used, ta.prompt_version, ta.sentiment, ta.call_quality
+                   {', ta.analysis_result' if full else ''}
+            FROM transcription_analysis ta
+            WHERE ta.transcription_id = t.id
+            ORDER BY ta.id DESC
+            LIMIT 1
+        ) la ON TRUE
+        """
+
+    query = f"""
+        SELECT {FULL_COLUMNS if full else SLIM_COLUMNS}
+        {source}
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY {id_column} DESC
+        LIMIT %s
+    """
+    rows = run_query(query, args + [limit])
+    return {
+        'items': rows,
+        'count': len(rows),
+        'next_after': rows[-1]['id'] if len(rows) == limit else None
+    }
+
+
+def get_transcription(transcription_id):
+    """Транскрипция целиком со всеми анализами (от новых к старым)"""
+    rows = run_query("SELECT * FROM transcriptions WHERE id = %s", (transcription_id,))
+    if not rows:
+        return None
+    result = rows[0]
+    result['analyses'] = run_query("""
+        SELECT id, analysis_date, model_used, prompt_version, status, sentiment, call_quality,
+               analysis_result, processing_time, stage_timings
+        FROM transcription_analysis
+        WHERE transcription_id = %s
+        ORDER BY id DESC
+    """, (transcription_id,))
+    return result
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, payload, endpoint, cached=False):
+        body = payload if isinstance(payload, bytes) else json.dumps(
+            payload, ensure_ascii=False, default=str
+        ).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', 'HIT' if cached else 'MISS')
+        self.end_headers()
+        self.wfile.write(body)
+        REQUESTS.labels(endpoint, status).inc()
+        return body
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/health':
+            return self.send_json(200, {'status': 'ok'}, 'health')
+        if url.path == '/metrics':
+            body = generate_latest()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        detail = re.fullmatch(r'/transcriptions/(\d+)', url.path)
+        if url.path == '/transcriptions':
+            endpoint = 'list'
+        elif detail:
+            endpoint = 'detail'
+        else:
+            return self.send_json(404, {'error': 'not found'}, 'unknown')
+
+        cache_key = (url.path, tuple(sorted(params.items())))
+        cached_body = cache.get(cache_key)
+        if cached_body is not None:
+            CACHE_HITS.inc()
+            return self.send_json(200, cached_body, endpoint, cached=True)
+
+        generation = cache.generation
+        try:
+            if detail:
+                payload = get_transcription(int(detail.group(1)))
+                if payload is None:
+                    return self.send_json(404, {'error': 'not found'}, endpoint)
+            else:
+                payload = list_transcriptions(params)
+        except BadRequest as e:
+            return self.send_json(400, {'error': str(e)}, endpoint)
+        except pool.PoolError:
+            logger.warning("Connection pool exhausted")
+            return self.send_json(503, {'error': 'service busy'}, endpoint)
+        except psycopg2.Error as e:
+            logger.error(f"Database error: {e}")
+            return self.send_json(500, {'error': 'database error'}, endpoint)
+
+        body = self.send_json(200, payload, endpoint)
+        cache.put(cache_key, body, generation)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def listen_for_changes():
+    """
+    Фоновый поток: LISTEN analysis_changed на основном сервере (на репликах NOTIFY
+    не доставляется). При потере соединения кэш живет только по TTL до переподключения
+    """
+    listen_params = dict(DB_PARAMS, host=LISTEN_DB_HOST)
+    while True:
+        try:
+            conn = psycopg2.connect(**listen_params)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("LISTEN analysis_changed")
+            logger.info("Listening for analysis_changed notifications")
+
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    cache.invalidate()
+                    CACHE_INVALIDATIONS.inc()
+        except Exception as e:
+            logger.error(f"Notification listener error: {e}")
+            time.sleep(5)
+
+
+def main():
+    global db_pool
+    db_pool = pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, **DB_PARAMS)
+
+    conn = db_pool.getconn()
+    try:
+        conn.autocommit = True
+        # Роли whisper_reader доступны только таблицы результатов
+        problems = validate_schema(conn, tables=READ_TABLES)
+    finally:
+        db_pool.putconn(conn)
+    for problem in problems:
+        logger.critical(problem)
+    if problems:
+        raise SystemExit(1)
+
+    threading.Thread(target=listen_for_changes, daemon=True).start()
+
+    server = ThreadingHTTPServer(('0.0.0.0', API_PORT), QueryHandler)
+    logger.info(f"Query service listening on port {API_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        db_pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
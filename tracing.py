@@ -0,0 +1,110 @@
+import os
+import json
+import uuid
+import socket
+import logging
+from datetime import datetime, timezone
+
+# ==================== ТРАССИРОВКА ЗВОНКА ЧЕРЕЗ ВЕСЬ КОНВЕЙЕР ====================
+# Каждая транскрипция получает trace_id в DBLoader. Он хранится в строке
+# transcriptions, попадает в файл задачи генератора и доходит до watcher.py.
+# Каждый этап пишет span-запись одной JSON-строкой - promtail разбирает её
+# json-стадией и Loki позволяет собрать всю цепочку по trace_id.
+# Модуль общий для сервисов Linux-сервера (scripts/) и watcher.py - формат span
+# определен только здесь, на Windows-станцию он копируется вместе с watcher.
+
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH')
+
+_span_logger = None
+
+
+def new_trace_id():
+    """Генерация нового идентификатора трассировки"""
+    return uuid.uuid4().hex
+
+
+def _utc_iso(value):
+    """Приведение datetime/timestamp к ISO-строке в UTC"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value, tz=timezone.utc)
+    elif value.tzinfo is None:
+        value = value.astimezone(timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+def parse_iso(value):
+    """
+    Разбор ISO-отметки из контекста трассировки файла задачи. Отметки без зоны
+    (задачи старого формата) не учитываются: сервер и Windows-станция могут жить
+    в разных часовых поясах
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else None
+
+
+def _to_epoch(value):
+    """Приведение datetime/timestamp к секундам с начала эпохи"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return value.timestamp()
+
+
+def get_span_logger(service, log_path=None):
+    """
+    Логгер для span-записей. Сообщение - чистый JSON без префиксов,
+    чтобы promtail мог разобрать строку json-стадией
+    """
+    global _span_logger
+    if _span_logger is not None:
+        return _span_logger
+
+    span_logger = logging.getLogger(f'{service}.trace')
+    span_logger.setLevel(logging.INFO)
+    span_logger.propagate = False
+
+    json_formatter = logging.Formatter('%(message)s')
+    path = log_path or TRACE_LOG_PATH
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handler = logging.FileHandler(path, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(json_formatter)
+    span_logger.addHandler(handler)
+
+    _span_logger = span_logger
+    return span_logger
+
+
+def emit_span(service, stage, trace_id, start, end, **ids):
+    """
+    Запись одного span: этап, границы по времени и идентификаторы звонка.
+    start/end - datetime или unix timestamp. Возвращает длительность в мс
+    """
+    duration_ms = round((_to_epoch(end) - _to_epoch(start)) * 1000, 1)
+    record = {
+        'ts': _utc_iso(datetime.now(timezone.utc)),
+        'type': 'span',
+        'service': service,
+        'host': socket.gethostname(),
+        'trace_id': trace_id,
+        'stage': stage,
+        'start': _utc_iso(start),
+        'end': _utc_iso(end),
+        'duration_ms': duration_ms,
+    }
+    record.update({key: value for key, value in ids.items() if value is not None})
+
+    try:
+        get_span_logger(service).info(json.dumps(record, ensure_ascii=False, default=str))
+    except Exception as e:
+        # Трассировка не должна ломать обработку звонка
+        logging.getLogger(service).warning(f"Не удалось записать span {stage}: {e}")
+    return duration_ms
@@ -4,14 +4,21 @@ import json
 import re
 import psutil
 import requests
+import uuid
 import psycopg2
 from psycopg2 import sql
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Загрузка переменных окружения
 from dotenv import load_dotenv
 load_dotenv()
 
+from prometheus_client import Counter, start_http_server
+
+from preprocess import preprocess_transcript
+from router import classify_call, trivial_analysis, TEMPLATE_MODEL_NAME
+from tracing import emit_span, get_span_logger, parse_iso
+
 # Конфигурация из переменных окружения. IP адрес нужно указать ваш, это будет адрес вашего сервера. Порты LM
 # смотрите так же под ваш проект, порт 8080 в моем случае выбран для отсутствия конфликта, так как ранее в проекте
 # присутствовал Суперсет
@@ -29,7 +36,36 @@ db_config = {
 
 # Название модели Mistral 7B - эта модель влезает в мою память, плюс хороша в тексте, как вариант можно попробовать
 # Phi от Майкрософт, о ней тоже хорошие отзывы именно про работу с текстом, коим транскрипция и явялется
-LM_MODEL_NAME = "Mistral-7B-Instruct-v0.3-Q4_K_M.gguf"
+LM_MODEL_NAME = os.getenv('LM_STUDIO_MODEL', "Mistral-7B-Instruct-v0.3-Q4_K_M.gguf")
+
+# Версия промпта сохраняется вместе с анализом. При любом изменении текста промпта версию нужно
+# поднять - по паре (модель, версия промпта) scripts/backfill.py находит звонки для повторного анализа
+PROMPT_VERSION = os.getenv('PROMPT_VERSION', 'v1')
+
+# Модели по уровням маршрутизации (router.py), тривиальные звонки обходятся без LM
+TIER_MODELS = {
+    'standard': os.getenv('LM_STUDIO_MODEL_STANDARD', LM_MODEL_NAME),
+    'complex': os.getenv('LM_STUDIO_MODEL_COMPLEX', LM_MODEL_NAME)
+}
+WATCHER_METRICS_PORT = int(os.getenv('WATCHER_METRICS_PORT', '8003'))
+
+# Минимальная версия схемы БД (scripts/migrations), с которой работает watcher
+REQUIRED_SCHEMA_VERSION = 3
+
+# Доля звонков по уровням: watcher_routed_calls_total{tier} / sum(watcher_routed_calls_total)
+ROUTED_CALLS = Counter('watcher_routed_calls', 'Calls routed per tier', ['tier', 'reason'])
+
+# Задачи повторного анализа (scripts/backfill.py) обрабатываются только после живых задач
+BACKFILL_PREFIX = 'backfill_'
+
+# Предобработка транскрипции перед промптом (исходный текст в БД не меняется)
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', '1') == '1'
+PREPROCESS_FILLERS = os.getenv('PREPROCESS_FILLERS', '0') == '1'
+
+# Трассировка: span-записи пишутся JSON-строками в общую папку, откуда их забирает promtail
+# на Linux-сервере. Разбивку по этапам можно дополнительно сохранять в строку анализа
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH', os.path.join(UNC_PATH, 'logs', 'trace-watcher.jsonl'))
+TRACE_STORE_TIMINGS = os.getenv('TRACE_STORE_TIMINGS', '1') == '1'
 
 def contains_russian(text):
     """Проверяет содержит ли текст русские буквы"""
@@ -74,7 +110,7 @@ def clean_lm_response(response_text):
     
     return text
 
-def analyze_with_lm_studio(text):
+def analyze_with_lm_studio(text, model=LM_MODEL_NAME):
     """Анализ текста с помощью LM Studio и Mistral 7B"""
     try:
         api_url = f"{LM_BASE_URL}/v1/chat/completions"
@@ -105,7 +141,7 @@ def analyze_with_lm_studio(text):
 Транскрипция для анализа:"""
         
         payload = {
-            "model": LM_MODEL_NAME,
+            "model": model,
             "messages": [
                 {
                     "role": "user", 
@@ -118,7 +154,7 @@ def analyze_with_lm_studio(text):
             "stream": False
         }
         
-        print(f"📨 Отправка запроса к LM Studio с моделью: {LM_MODEL_NAME}")
+        print(f"📨 Отправка запроса к LM Studio с моделью: {model}")
         response = requests.post(api_url, json=payload, timeout=600)  # 10 минут таймаут
         
         if response.status_code == 200:
@@ -178,14 +214,14 @@ def split_long_text(text, max_tokens=3000):
     
     return chunks
 
-def analyze_long_text(text):
+def analyze_long_text(text, model=LM_MODEL_NAME):
     """Анализ длинного текста по частям"""
     chunks = split_long_text(text, max_tokens=3000)
     all_results = []
     
     for i, chunk in enumerate(chunks):
         print(f"📄 Анализ части {i+1}/{len(chunks)} ({(i+1)/len(chunks)*100:.1f}%)...")
-        result = analyze_with_lm_studio(chunk)
+        result = analyze_with_lm_studio(chunk, model)
         if result:
             try:
                 result_data = json.loads(result)
@@ -213,8 +249,41 @@ def get_db_connection():
         print(f"❌ Ошибка подключения к БД: {e}")
         return None
 
-def save_analysis_to_db(transcription_id, analysis_result):
-    """Сохранение результата анализа в базу данных"""
+def check_schema_version():
+    """Проверка, что на сервере применены нужные миграции схемы"""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_migrations')")
+            if cur.fetchone()[0] is None:
+                version = 0
+            else:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                version = cur.fetchone()[0]
+        
+        if version < REQUIRED_SCHEMA_VERSION:
+            print(f"❌ Версия схемы БД {version}, требуется {REQUIRED_SCHEMA_VERSION}. "
+                  f"Запустите scripts/migrate.py на сервере")
+            return False
+        print(f"✅ Версия схемы БД: {version}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка проверки схемы БД: {e}")
+        return False
+    finally:
+        conn.close()
+
+def save_analysis_to_db(transcription_id, analysis_result, trace_id=None, stage_timings=None,
+                        processing_time=None, model=LM_MODEL_NAME, prompt_version=PROMPT_VERSION,
+                        save_started_at=None):
+    """
+    Сохранение результата анализа в базу данных. С save_started_at в stage_timings
+    добавляется db_save_ms - время сохранения до фиксации транзакции
+    """
     conn = get_db_connection()
     if not conn:
         return False
@@ -224,12 +293,29 @@ def save_analysis_to_db(transcription_id, analysis_result):
         analysis_data = json.loads(analysis_result)
         
         with conn.cursor() as cur:
-            # ОБНОВЛЕННЫЙ ЗАПРОС С model_used
+            # Повторная обработка с той же моделью и промптом заменяет анализ, а не дублирует его.
+            # Строка удаляется и вставляется заново, чтобы у последнего анализа всегда был
+            # наибольший id - на это опираются backfill, сервис чтения и выгрузка
+            cur.execute("""
+                DELETE FROM transcription_analysis
+                WHERE transcription_id = %s AND model_used = %s AND prompt_version = %s
+            """, (transcription_id, model, prompt_version))
             cur.execute("""
                 INSERT INTO transcription_analysis 
-                (transcription_id, analysis_result, analysis_date, model_used) 
-                VALUES (%s, %s, %s, %s)
-            """, (transcription_id, analysis_result, datetime.now(), LM_MODEL_NAME))
+                (transcription_id, analysis_result, analysis_date, model_used, prompt_version,
+                 trace_id, stage_timings, processing_time) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (transcription_id, analysis_result, datetime.now(), model, prompt_version,
+                  trace_id, json.dumps(stage_timings) if stage_timings else None, processing_time))
+            analysis_id = cur.fetchone()[0]
+            if stage_timings and save_started_at:
+                db_save_ms = round((datetime.now(timezone.utc) - save_started_at).total_seconds() * 1000, 1)
+                cur.execute("""
+                    UPDATE transcription_analysis
+                    SET stage_timings = stage_timings || %s::jsonb
+                    WHERE id = %s
+                """, (json.dumps({'db_save_ms': db_save_ms}), analysis_id))
             conn.commit()
         
         print(f"💾 Анализ сохранен в БД для transcription_id: {transcription_id}")
@@ -245,20 +331,66 @@ def save_analysis_to_db(transcription_id, analysis_result):
     finally:
         conn.close()
 
-def process_task(task_path, task_id, transcription_id):
+def process_task(task_path, task_id, transcription_id, picked_at=None):
     """Обработка отдельной задачи"""
     try:
         with open(task_path, 'r', encoding='utf-8') as f:
             task_data = json.load(f)
         
-        text = task_data.get('text', '')
-        if not text or len(text.strip()) < 10:
-            print(f"⚠️ Пустой или слишком короткий текст в задаче {task_id}")
-            return False
+        # Контекст трассировки из файла задачи (старые задачи получают новый trace_id)
+        trace = task_data.get('trace') or {}
+        trace_id = trace.get('trace_id') or uuid.uuid4().hex
+        picked_at = picked_at or datetime.now(timezone.utc)
+        # Этапы db-loader и генератора (ingest_wait, ingest, generator_wait, task_create) приходят
+        # в файле задачи, этапы watcher добавляются к ним
+        timings = trace.get('timings')
+        stage_timings = dict(timings) if isinstance(timings, dict) else {}
+        span_ids = {'transcription_id': transcription_id, 'task_id': task_id}
+        
+        ingested_at = parse_iso(trace.get('ingested_at'))
+        enqueued_at = parse_iso(trace.get('enqueued_at'))
+        if ingested_at and enqueued_at and 'generator_wait_ms' not in stage_timings:
+            # Задачи без timings: ожидание в генераторе вместе с созданием задачи
+            stage_timings['generator_wait_ms'] = round((enqueued_at - ingested_at).total_seconds() * 1000, 1)
+        if enqueued_at:
+            # Часы Linux-сервера и Windows-станции должны быть синхронизированы (NTP)
+            stage_timings['smb_wait_ms'] = emit_span('watcher', 'smb_wait', trace_id, enqueued_at, picked_at,
+                                                     **span_ids)
+        
+        # Задачи повторного анализа задают версию промпта сами, модель всегда выбирается по уровню
+        prompt_version = task_data.get('prompt_version') or PROMPT_VERSION
+        
+        text = task_data.get('text') or ''
+        
+        # Нормализация: галлюцинации Whisper, зацикленные фразы, пробелы и пунктуация
+        if text and PREPROCESS_ENABLED:
+            preprocess_started_at = datetime.now(timezone.utc)
+            text, stats = preprocess_transcript(text, fillers=PREPROCESS_FILLERS)
+            stage_timings['preprocess_ms'] = emit_span('watcher', 'preprocess', trace_id, preprocess_started_at,
+                                                       datetime.now(timezone.utc), **stats, **span_ids)
+            stage_timings['tokens_saved'] = stats['tokens_saved']
+            print(f"✂️ Предобработка: {stats['chars_before']} -> {stats['chars_after']} символов, "
+                  f"сэкономлено ~{stats['tokens_saved']} токенов")
         
         text_length = len(text)
         print(f"🔍 Анализируем задачу {task_id}, длина текста: {text_length} символов")
         
+        # Маршрутизация: тривиальные звонки получают шаблонный анализ без LM Studio.
+        # Пустой или очень короткий текст (сброс, "Алло", тишина, очищенная предобработкой)
+        # тоже уходит в шаблон: иначе задача попадет в failed, а звонок останется без анализа
+        route_started_at = datetime.now(timezone.utc)
+        tier, reason = classify_call(text)
+        ROUTED_CALLS.labels(tier, reason).inc()
+        stage_timings['route_ms'] = emit_span('watcher', 'route', trace_id, route_started_at,
+                                              datetime.now(timezone.utc), tier=tier, reason=reason, **span_ids)
+        print(f"🧭 Уровень звонка: {tier} ({reason})")
+        
+        if tier == 'trivial':
+            return save_task_result(transcription_id, trivial_analysis(reason), task_id, trace_id, span_ids,
+                                    stage_timings, picked_at, TEMPLATE_MODEL_NAME, prompt_version)
+        
+        model = TIER_MODELS[tier]
+        
         # Проверяем доступность LM Studio
         if not check_lm_studio():
             print("❌ LM Studio недоступен, пропускаем задачу")
@@ -267,28 +399,45 @@ def process_task(task_path, task_id, transcription_id):
         print("✅ LM Studio доступен, начинаем анализ...")
         
         # Выбираем метод анализа в зависимости от длины текста
+        lm_started_at = datetime.now(timezone.utc)
         if text_length > 8000:  # Длинные тексты анализируем по частям
             print("📖 Текст длинный, анализируем по частям...")
-            analysis_result = analyze_long_text(text)
+            analysis_result = analyze_long_text(text, model)
         else:  # Короткие тексты анализируем целиком
-            analysis_result = analyze_with_lm_studio(text)
+            analysis_result = analyze_with_lm_studio(text, model)
+        stage_timings['lm_request_ms'] = emit_span('watcher', 'lm_request', trace_id, lm_started_at,
+                                                   datetime.now(timezone.utc), ok=bool(analysis_result), **span_ids)
         
         if not analysis_result:
             print(f"❌ Не удалось проанализировать задачу {task_id}")
             return False
         
-        # Сохранение в базу данных
-        if save_analysis_to_db(transcription_id, analysis_result):
-            print(f"✅ Задача {task_id} успешно обработана и сохранена в БД")
-            return True
-        else:
-            print(f"❌ Ошибка сохранения задачи {task_id} в БД")
-            return False
+        return save_task_result(transcription_id, analysis_result, task_id, trace_id, span_ids,
+                                stage_timings, picked_at, model, prompt_version)
         
     except Exception as e:
         print(f"❌ Ошибка обработки задачи {task_id}: {e}")
         return False
 
+def save_task_result(transcription_id, analysis_result, task_id, trace_id, span_ids, stage_timings,
+                     picked_at, model, prompt_version):
+    """Сохранение результата задачи в базу данных со span db_save"""
+    save_started_at = datetime.now(timezone.utc)
+    saved = save_analysis_to_db(
+        transcription_id, analysis_result, trace_id=trace_id,
+        stage_timings=stage_timings if TRACE_STORE_TIMINGS else None,
+        processing_time=save_started_at - picked_at,
+        model=model, prompt_version=prompt_version, save_started_at=save_started_at
+    )
+    emit_span('watcher', 'db_save', trace_id, save_started_at, datetime.now(timezone.utc), ok=saved, **span_ids)
+    
+    if saved:
+        print(f"✅ Задача {task_id} успешно обработана и сохранена в БД")
+        return True
+    else:
+        print(f"❌ Ошибка сохранения задачи {task_id} в БД")
+        return False
+
 def ensure_directories_exist():
     """Создание необходимых директорий если они отсутствуют"""
     directories = [
@@ -313,13 +462,16 @@ def main():
     print("🚀 Запуск Transcription Watcher с Mistral 7B")
     print("=" * 70)
     print(f"📡 LM Studio URL: {LM_BASE_URL}")
-    print(f"🧠 Модель: {LM_MODEL_NAME}")
+    print(f"🧠 Модель: {LM_MODEL_NAME} (промпт {PROMPT_VERSION})")
     print(f"📂 SMB Share: {UNC_PATH}")
     print(f"🗄️ DB Host: {db_config['host']}")
     print("=" * 70)
     
     # Проверка подключений
     print("🔍 Проверка подключений...")
+    start_http_server(WATCHER_METRICS_PORT)
+    print(f"📈 Метрики маршрутизации: http://0.0.0.0:{WATCHER_METRICS_PORT}/metrics")
+    
     if not check_lm_studio():
         print("⚠️ ВНИМАНИЕ: LM Studio недоступен!")
         print("Убедитесь, что LM Studio запущен на http://localhost:8080")
@@ -327,10 +479,20 @@ def main():
     else:
         print("✅ LM Studio доступен")
     
+    if not check_schema_version():
+        return
+    
     if not ensure_directories_exist():
         print("❌ Ошибка создания директорий")
         return
     
+    # Span-записи - в общую папку, откуда их забирает promtail (формат задан в tracing.py)
+    try:
+        get_span_logger('watcher', TRACE_LOG_PATH)
+    except OSError as e:
+        # Трассировка не должна мешать обработке задач - span уйдут в консоль
+        print(f"⚠️ Не удалось открыть лог трассировки {TRACE_LOG_PATH}: {e}")
+    
     print("👂 Watcher запущен, ожидание задач...")
     print("Нажмите Ctrl+C для остановки")
     print("=" * 70)
@@ -342,29 +504,43 @@ def main():
             completed_dir = os.path.join(UNC_PATH, 'completed')
             failed_dir = os.path.join(UNC_PATH, 'failed')
             
-            # Обработка задач в директории pending
-            task_files = [f for f in os.listdir(pending_dir) if f.endswith('.json')]
+            # Обработка задач в директории pending, живые задачи идут перед повторным анализом
+            task_files = sorted(
+                (f for f in os.listdir(pending_dir) if f.endswith('.json')),
+                key=lambda f: f.startswith(BACKFILL_PREFIX)
+            )
+            live_arrived = False
             
             if task_files:
                 print(f"📋 Найдено задач: {len(task_files)}")
             
             for task_file in task_files:
+                # Перед каждой задачей повторного анализа проверяем, не появились ли живые задачи
+                if task_file.startswith(BACKFILL_PREFIX) and any(
+                    f.endswith('.json') and not f.startswith(BACKFILL_PREFIX)
+                    for f in os.listdir(pending_dir)
+                ):
+                    live_arrived = True
+                    break
+                
                 task_path = os.path.join(pending_dir, task_file)
                 processing_path = os.path.join(processing_dir, task_file)
                 
                 try:
                     # Перемещаем в processing
+                    picked_at = datetime.now(timezone.utc)
                     os.rename(task_path, processing_path)
                     
                     with open(processing_path, 'r', encoding='utf-8') as f:
                         task_data = json.load(f)
                     
                     task_id = task_data.get('task_id', 'unknown')
-                    transcription_id = task_data.get('transcription_id')
+                    # Старые задачи генератора передают идентификатор только в поле id
+                    transcription_id = task_data.get('transcription_id') or task_data.get('id')
                     
                     print(f"🔄 Обработка задачи: {task_id}")
                     
-                    success = process_task(processing_path, task_id, transcription_id)
+                    success = process_task(processing_path, task_id, transcription_id, picked_at)
                     
                     # Перемещаем в completed или failed
                     if success:
@@ -388,8 +564,9 @@ def main():
                     except:
                         pass
             
-            # Пауза перед следующей проверкой
-            time.sleep(15)
+            # Пауза перед следующей проверкой (живые задачи берем сразу)
+            if not live_arrived:
+                time.sleep(15)
             
         except KeyboardInterrupt:
             print("\n🛑 Watcher остановлен пользователем")